@@ -0,0 +1,38 @@
+####################################################################################
+#            BENCHMARK: batched chi2 grid vs a Python loop over grid points        #
+#                                                                                  #
+#         Run from the repository root with: python -m benchmarks.chi2_grid        #
+####################################################################################
+
+import time
+import numpy as np
+
+from cfit import dataset, fitting, function
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    func = function.functions_dict['Gaussian']
+
+    print(f'{"points":>8} {"grid":>9} {"loop [s]":>10} {"batched [s]":>12} {"speedup":>8}')
+    for num_points, n in [(1_000, 100), (10_000, 100), (10_000, 200)]:
+        x = np.linspace(1, 10, num_points)
+        y_err = np.full(num_points, 0.1)
+        data = dataset.Dataset.from_arrays(x, func(x, 1.0, 5.0, 4.0, 0.8) + rng.normal(0, y_err), y_err)
+        fit = fitting.Fit(data, func)
+
+        start = time.perf_counter()
+        a_values, b_values, chi2 = fit.chi2_grid('mu', 'sigma', n=n)
+        batched = time.perf_counter() - start
+
+        #The same grid, one Function.chi2 call per grid point
+        P = np.tile(fit.fit_params, (n*n, 1))
+        A, B = np.meshgrid(a_values, b_values, indexing='ij')
+        P[:, 2] = A.ravel()
+        P[:, 3] = B.ravel()
+        start = time.perf_counter()
+        chi2_loop = np.array([func.chi2(p, data) for p in P]).reshape(n, n)
+        loop = time.perf_counter() - start
+
+        assert np.allclose(chi2, chi2_loop)
+        print(f'{num_points:>8} {f"{n}x{n}":>9} {loop:>10.2f} {batched:>12.2f} {loop/batched:>7.1f}x')
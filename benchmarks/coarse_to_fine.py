@@ -0,0 +1,41 @@
+####################################################################################
+#             BENCHMARK: coarse-to-fine guessing on large datasets                 #
+#                                                                                  #
+#     Run from the repository root with: python -m benchmarks.coarse_to_fine       #
+####################################################################################
+
+import time
+import numpy as np
+
+from cfit import dataset, fitting, function
+
+def _make_dataset(name, num_points, rng):
+    x = np.linspace(1, 10, num_points)
+    true_params = {
+        'Gaussian': [1.0, 5.0, 4.0, 0.8],
+        'Lorentzian': [1.0, 5.0, 6.0, 1.2],
+        'Sine wave': [0.5, 2.0, 3.0, 1.0],
+        'Exponential': [1.0, 2.0, -0.4],
+    }[name]
+    y_err = np.full(num_points, 0.1)
+    y = function.functions_dict[name](x, *true_params) + rng.normal(0, y_err)
+    return dataset.Dataset.from_arrays(x, y, y_err)
+
+def _time_fit(data, func, max_points):
+    start = time.perf_counter()
+    fit = fitting.Fit(data, func, max_points=max_points)
+    return time.perf_counter() - start, fit
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    num_points = 1_000_000
+    max_points = 2_000
+
+    print(f'{"function":<12} {"mode":<16} {"time [s]":>10} {"red_chi2":>10}')
+    for name in ['Gaussian', 'Lorentzian', 'Sine wave', 'Exponential']:
+        data = _make_dataset(name, num_points, rng)
+        func = function.functions_dict[name]
+        for label, mp in [('full', None), (f'max_points={max_points}', max_points)]:
+            elapsed, fit = _time_fit(data, func, mp)
+            print(f'{name:<12} {label:<16} {elapsed:>10.2f} {fit.red_chi2:>10.4f}')
@@ -0,0 +1,55 @@
+####################################################################################
+#        BENCHMARK: multi-start vs differential evolution parameter guessing       #
+#                                                                                  #
+#        Run from the repository root with: python -m benchmarks.multistart        #
+####################################################################################
+
+import time
+import numpy as np
+
+from cfit import dataset, function, guess_params
+
+# (function name, true parameters) for each benchmark dataset. Piecewise-constant
+# models (e.g. 'Square wave') are left out, since guess_params always uses
+# differential evolution for them.
+_CASES = [
+    ('Sine wave', [0.5, 2.0, 3.0, 1.0]),
+    ('Gaussian', [1.0, 5.0, 4.0, 0.8]),
+    ('Gaussian', [3.0, -4.0, 6.5, 1.5]),
+    ('Poisson', [0.5, 20.0, 4.0]),
+    ('Laplacian', [1.0, 5.0, 5.0, 0.7]),
+    ('Lorentzian', [1.0, 5.0, 6.0, 1.2]),
+    ('Power', [2.0, 1.5]),
+]
+
+def _make_dataset(name, true_params, num_points, rng):
+    x = np.linspace(1, 10, num_points)
+    y_err = np.full(num_points, 0.1)
+    y = function.functions_dict[name](x, *true_params) + rng.normal(0, y_err)
+    return dataset.Dataset.from_arrays(x, y, y_err)
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    num_points = 2_000
+
+    # A guess counts as a success if its reduced chi2 is within 50% of the true parameters'
+    print(f'{"function":<12} {"method":<12} {"time [s]":>10} {"red_chi2":>10} {"success":>8}')
+    totals = {'de': [0.0, 0], 'multistart': [0.0, 0]}
+    for name, true_params in _CASES:
+        data = _make_dataset(name, true_params, num_points, rng)
+        func = function.functions_dict[name]
+        dof = data.num_points - func.num_params
+        true_red_chi2 = func.chi2(true_params, data)/dof
+        for method in ['de', 'multistart']:
+            start = time.perf_counter()
+            params = guess_params.guess_params(data, func, method=method)
+            elapsed = time.perf_counter() - start
+            red_chi2 = func.chi2(params, data)/dof
+            success = red_chi2 < 1.5*true_red_chi2
+            totals[method][0] += elapsed
+            totals[method][1] += success
+            print(f'{name:<12} {method:<12} {elapsed:>10.3f} {red_chi2:>10.3f} {str(success):>8}')
+
+    for method, (elapsed, successes) in totals.items():
+        print(f'{method}: total time {elapsed:.2f} s, {successes}/{len(_CASES)} successes')
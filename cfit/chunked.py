@@ -0,0 +1,165 @@
+####################################################################################
+#                                    LIBRARIES                                     #
+####################################################################################
+
+import numpy as np
+import scipy.linalg as linalg
+
+####################################################################################
+#                    Chunked (out-of-core) evaluation and fitting                  #
+####################################################################################
+
+# Everything here walks the dataset in blocks of chunk_size points, so only
+# O(chunk_size * num_params) floats are ever held in memory at once on top of the
+# dataset itself (which may be memory-mapped, e.g. Dataset.from_arrays(np.load(..., mmap_mode='r'), ...)).
+
+# Yield slices covering [0, num_points) in blocks of chunk_size
+def iter_chunks(num_points, chunk_size):
+    if(chunk_size < 1):
+        raise ValueError('Chunk size must be positive.')
+    for start in range(0, num_points, chunk_size):
+        yield slice(start, min(start+chunk_size, num_points))
+
+# Weighted residuals (y-y_fit)/y_err for one block of the dataset
+def _block_residuals(function, params, dataset, block):
+    y_fit = function.func(dataset.x[block], *params)
+    r = np.asarray(dataset.y[block], dtype=float) - y_fit
+    if(dataset.y_err is not None):
+        r /= dataset.y_err[block]
+    return r
+
+# Chi2 accumulated block by block
+def chi2(function, params, dataset, chunk_size):
+    total = 0.0
+    for block in iter_chunks(dataset.num_points, chunk_size):
+        r = _block_residuals(function, params, dataset, block)
+        total += np.dot(r, r)
+    return total
+
+# Weighted residuals written block by block into out (e.g. a np.memmap)
+def residuals(function, params, dataset, chunk_size, out=None):
+    if(out is None):
+        out = np.empty(dataset.num_points)
+    for block in iter_chunks(dataset.num_points, chunk_size):
+        out[block] = _block_residuals(function, params, dataset, block)
+    return out
+
+# Accumulate J^T J, J^T r and chi2 block by block, with J the Jacobian of the
+# weighted model y_fit/y_err: analytic if the function has one, otherwise
+# estimated by forward differences (as curve_fit does)
+def normal_equations(function, params, dataset, chunk_size):
+    params = np.asarray(params, dtype=float)
+    num_params = len(params)
+    steps = np.sqrt(np.finfo(float).eps)*np.maximum(1.0, np.abs(params))
+    JTJ = np.zeros((num_params, num_params))
+    JTr = np.zeros(num_params)
+    total = 0.0
+    for block in iter_chunks(dataset.num_points, chunk_size):
+        x = dataset.x[block]
+        y_fit = function.func(x, *params)
+        if(function.jac is not None):
+            J = function.jacobian(x, params)
+        else:
+            J = np.empty((len(y_fit), num_params))
+            for i in range(num_params):
+                shifted = params.copy()
+                shifted[i] += steps[i]
+                J[:, i] = (function.func(x, *shifted) - y_fit)/steps[i]
+        r = np.asarray(dataset.y[block], dtype=float) - y_fit
+        if(dataset.y_err is not None):
+            y_err = dataset.y_err[block]
+            r /= y_err
+            J /= y_err[:, None]
+        JTJ += J.T @ J
+        JTr += J.T @ r
+        total += np.dot(r, r)
+    return JTJ, JTr, total
+
+# Largest cosine between the residuals and a column of the Jacobian (MINPACK's
+# gtol test): zero at a stationary point of chi2, independently of the scaling
+def _scaled_gradient(JTJ, JTr, chi2):
+    norms = np.sqrt(np.diag(JTJ)*chi2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosines = np.where(norms > 0, np.abs(JTr)/norms, 0.0)
+    return np.max(cosines, initial=0.0)
+
+# Decrease in chi2 predicted by the linearised model for the step delta
+def _predicted_reduction(JTJ, JTr, delta):
+    return np.dot(delta, 2*JTr - JTJ @ delta)
+
+# Levenberg-Marquardt on the chunk-accumulated normal equations. Mirrors the
+# return value of scipy.optimize.curve_fit: (optimal parameters, covariance).
+# The damping follows the ratio of actual to predicted chi2 reduction (Nielsen's
+# update), so poorly predicted steps are damped rather than encouraged. A small
+# step or chi2 change only counts as convergence if a step with the damping
+# reset does not reduce chi2 significantly either; otherwise the run has merely
+# stalled and the fit continues (raising once max_iter is exceeded, as
+# curve_fit does).
+def curve_fit(function, dataset, p0, chunk_size, absolute_sigma=False, max_iter=200, ftol=1e-10, xtol=1e-10, gtol=1e-10):
+
+    params = np.asarray(p0, dtype=float)
+    lam_0 = 1e-3
+    lam = lam_0
+    nu = 2
+    JTJ, JTr, chi2_now = normal_equations(function, params, dataset, chunk_size)
+
+    converged = False
+    for _ in range(max_iter):
+        if(_scaled_gradient(JTJ, JTr, chi2_now) <= gtol):
+            converged = True
+            break
+
+        #Try damped steps until one reduces chi2
+        while(True):
+            A = JTJ + lam*np.diag(np.maximum(np.diag(JTJ), 1e-300))
+            try:
+                delta = linalg.solve(A, JTr, assume_a='sym')
+            except (linalg.LinAlgError, ValueError):
+                delta = None
+            if(delta is not None and np.all(np.isfinite(delta))):
+                params_new = params + delta
+                with np.errstate(all='ignore'):
+                    chi2_new = chi2(function, params_new, dataset, chunk_size)
+                predicted = _predicted_reduction(JTJ, JTr, delta)
+                if(np.isfinite(chi2_new) and chi2_new <= chi2_now and predicted > 0):
+                    rho = (chi2_now - chi2_new)/predicted
+                    if(rho > 1e-4 or chi2_now - chi2_new <= ftol*chi2_now):
+                        break
+            lam *= nu
+            nu *= 2
+            if(lam > 1e16):
+                raise RuntimeError('Optimal parameters not found: damping limit reached.')
+        lam = max(lam*max(1/3, 1 - (2*rho - 1)**3), 1e-12)
+        nu = 2
+
+        small_step = np.all(np.abs(delta) <= xtol*(np.abs(params)+xtol))
+        small_change = (chi2_now - chi2_new) <= ftol*chi2_now
+        params = params_new
+        JTJ, JTr, chi2_now = normal_equations(function, params, dataset, chunk_size)
+        if(small_step or small_change):
+            #Converged if a step with the damping reset does not reduce chi2
+            #significantly either; otherwise the fit only stalled, so carry on
+            lam = lam_0
+            try:
+                delta = linalg.solve(JTJ + lam*np.diag(np.maximum(np.diag(JTJ), 1e-300)), JTr, assume_a='sym')
+                with np.errstate(all='ignore'):
+                    chi2_new = chi2(function, params + delta, dataset, chunk_size)
+            except (linalg.LinAlgError, ValueError):
+                chi2_new = np.inf
+            if(not (chi2_now - chi2_new > ftol*chi2_now)):
+                converged = True
+                break
+
+    if(not converged):
+        raise RuntimeError('Optimal parameters not found: number of iterations exceeded max_iter.')
+
+    #Covariance from the final normal matrix, scaled as curve_fit does when
+    #the errors are only relative
+    try:
+        cov = linalg.pinvh(JTJ)
+    except linalg.LinAlgError:
+        cov = np.full((len(params), len(params)), np.inf)
+    if(not absolute_sigma):
+        dof = dataset.num_points - len(params)
+        cov = cov*chi2_now/dof if dof > 0 else np.full_like(cov, np.inf)
+    return params, cov
@@ -5,49 +5,199 @@
 import numpy as np
 import pandas as pd
 
+from . import chunked
+
+# Block size used when aggregating points (see _aggregate), so that reducing a large
+# (e.g. memory-mapped) dataset only holds O(num_groups + chunk_size) floats at once
+_CHUNK_SIZE = 2**16
+
 ####################################################################################
 #                                  CLASS: Dataset                                  #
 ####################################################################################
 
 class Dataset():
-    
+
     def __init__(self, file_path):
-        
+
         # Read data from file
         df = pd.read_table(file_path, # file path
                   delimiter=',|\s+|\t+', # delimiter can be ',' or spaces or tabs
                   engine='python') # engine='python' is needed for the delimiter to work
 
+        self._set_frame(df)
+
+    # Build a dataset from an in-memory DataFrame with 2 or 3 columns (x, y[, y_err])
+    @classmethod
+    def from_frame(cls, df):
+        dataset = cls.__new__(cls)
+        dataset._set_frame(df)
+        return dataset
+
+    # Build a dataset directly from arrays (no copy if already sorted float arrays)
+    @classmethod
+    def from_arrays(cls, x, y, y_err=None):
+        dataset = cls.__new__(cls)
+        dataset._set_arrays(x, y, y_err)
+        return dataset
+
+    def _set_frame(self, df):
+
         # CHECK #1: data has 2 or 3 columns
         ncols = len(df.columns)
-        if (ncols == 2):
-            df.columns = ['x', 'y']
-            self.y_err = None
-        elif (ncols == 3):
-            df.columns = ['x', 'y', 'y_err']
-            self.y_err = df['y_err'].values
-        else:
+        if (ncols not in [2, 3]):
             raise ValueError('Data must have 2 or 3 columns.')
 
+        # CHECK #2 (part): data is all numeric
+        # (Note: to_numeric converts non-numeric values to NaN, caught in _set_arrays)
+        columns = []
+        for i in range(ncols):
+            s = df.iloc[:, i]
+            if (not pd.api.types.is_float_dtype(s)):
+                s = pd.to_numeric(s, errors='coerce')
+            columns.append(s.to_numpy(dtype=float))
+
+        self._set_arrays(*columns)
+
+    def _set_arrays(self, x, y, y_err=None):
+
+        # np.asarray does not copy contiguous float64 arrays (including memmaps)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if (y_err is not None):
+            y_err = np.asarray(y_err, dtype=float)
+
+        # CHECK #1: data columns are 1D and of equal length
+        if (x.ndim != 1 or y.ndim != 1 or len(x) != len(y)):
+            raise ValueError('Data columns \'x\' and \'y\' must be 1D and of equal length.')
+        if (y_err is not None and (y_err.ndim != 1 or len(y_err) != len(x))):
+            raise ValueError('Data column \'y_err\' must be 1D and of equal length to \'x\'.')
+
         # CHECK #2: data is all numeric and doesn't contain NaN or Infs
-        # (Note: to_numeric converts non-numeric values to NaN)
-        df = df.apply(lambda s: pd.to_numeric(s, errors='coerce'))
-        is_finite = ~df.isin([np.nan, np.inf, -np.inf]).any().any()
+        is_finite = np.isfinite(x).all() and np.isfinite(y).all()
+        if (y_err is not None):
+            is_finite = is_finite and np.isfinite(y_err).all()
         if(not is_finite):
             raise ValueError('Data must be all numeric and cannot contain NaN or Inf.')
 
         # CHECK #3: Y-axis errors are positive
-        if (self.y_err is not None):
-            is_yerr_positive = df['y_err'].gt(0).all()
+        if (y_err is not None):
+            is_yerr_positive = (y_err > 0).all()
             if(not is_yerr_positive):
                 raise ValueError('Data must have positive \'y_err\'.')
-            
-        # Sort data by x values
-        df.sort_values(by=['x'], inplace=True)
-    
+
+        # Sort data by x values (skipped, and no copy made, if already sorted)
+        if (np.any(x[1:] < x[:-1])):
+            order = np.argsort(x, kind='stable')
+            x = x[order]
+            y = y[order]
+            if (y_err is not None):
+                y_err = y_err[order]
+
         # Set class variables
-        self._df = df
-        self.x = df['x'].values
-        self.y = df['y'].values
-        #self.y_err is set above
-        self.num_points = len(self.x)
\ No newline at end of file
+        self.x = x
+        self.y = y
+        self.y_err = y_err
+        self.num_points = len(self.x)
+
+        # Reduction state (see reduce): whether y_err are absolute measurement errors
+        # (rather than combined unit weights), the original number of points, the
+        # constant chi2 lost by aggregating, and the unreduced dataset
+        self.absolute_sigma = y_err is not None
+        self.num_raw_points = self.num_points
+        self.chi2_offset = 0.0
+        self.raw = None
+        self.reduction = None
+
+    # Reduce the dataset to num_points equal-count bins of neighbouring x values.
+    # Each bin is replaced by its inverse-variance weighted mean with the propagated
+    # error, so chi2 on the subsample stays on the same scale as on the full data.
+    def subsample(self, num_points, chunk_size=None):
+        if (num_points < 1):
+            raise ValueError('Number of subsample points must be positive.')
+        if (num_points >= self.num_points):
+            return self
+        starts = np.linspace(0, self.num_points, num_points, endpoint=False).astype(int)
+        return self._aggregate(starts, mode='subsample', chunk_size=chunk_size)
+
+    # Reduce the dataset by aggregating points into groups, replaced by their inverse-
+    # variance weighted means with combined errors. With bins=None, the groups are the
+    # points with exactly equal x, which is lossless: chi2 differs from the full data
+    # only by the within-group scatter, a constant kept in chi2_offset, and
+    # num_raw_points keeps the original count for the degrees of freedom. Otherwise,
+    # bins (a number of equal-width bins, or an array of bin edges) groups nearby x
+    # values, which is approximate; reduction['max_spread'] reports the widest x
+    # range merged into one point, and Fit evaluates its chi2 on the raw data.
+    def reduce(self, bins=None, chunk_size=None):
+        if (bins is None):
+            starts = self._group_starts(lambda x: x, chunk_size)
+            return self._aggregate(starts, mode='exact', chunk_size=chunk_size)
+        if (np.isscalar(bins)):
+            if (bins < 1):
+                raise ValueError('Number of bins must be positive.')
+            edges = np.linspace(self.x[0], self.x[-1], int(bins)+1)
+        else:
+            edges = np.sort(np.asarray(bins, dtype=float))
+            if (len(edges) < 2):
+                raise ValueError('At least two bin edges must be given.')
+        # Points outside the edges are merged into the first/last bin
+        bin_index = lambda x: np.clip(np.searchsorted(edges, x, side='right')-1, 0, len(edges)-2)
+        starts = self._group_starts(bin_index, chunk_size)
+        return self._aggregate(starts, mode='bins', chunk_size=chunk_size)
+
+    # Indices where key(x) changes value, i.e. the starts of the groups of consecutive
+    # points with equal keys, found block by block
+    def _group_starts(self, key, chunk_size=None):
+        starts = []
+        last = None
+        for block in chunked.iter_chunks(self.num_points, chunk_size or _CHUNK_SIZE):
+            k = key(self.x[block])
+            changed = np.r_[last is None or k[0] != last, k[1:] != k[:-1]]
+            starts.append(block.start + np.flatnonzero(changed))
+            last = k[-1]
+        return np.concatenate(starts)
+
+    # Aggregate the groups of consecutive points starting at the indices starts. The
+    # weighted sums are accumulated block by block, so only the per-group arrays and
+    # one block of points are held in memory.
+    def _aggregate(self, starts, mode, chunk_size=None):
+        chunk_size = chunk_size or _CHUNK_SIZE
+        num_groups = len(starts)
+        blocks = list(chunked.iter_chunks(self.num_points, chunk_size))
+
+        # Group of each point of a block (relative to the block's first group) and
+        # the weights of its points
+        def _block(block):
+            group = np.searchsorted(starts, np.arange(block.start, block.stop), side='right')-1
+            w = 1/self.y_err[block]**2 if self.y_err is not None else np.ones(block.stop-block.start)
+            return group[0], group-group[0], w
+
+        w_sum = np.zeros(num_groups)
+        wx_sum = np.zeros(num_groups)
+        wy_sum = np.zeros(num_groups)
+        for block in blocks:
+            first, group, w = _block(block)
+            n = group[-1]+1
+            w_sum[first:first+n] += np.bincount(group, weights=w, minlength=n)
+            wx_sum[first:first+n] += np.bincount(group, weights=w*self.x[block], minlength=n)
+            wy_sum[first:first+n] += np.bincount(group, weights=w*self.y[block], minlength=n)
+        x = self.x[starts] if mode == 'exact' else wx_sum/w_sum
+        y = wy_sum/w_sum
+
+        # Scatter of the points about their group means, lost by aggregating
+        within_chi2 = 0.0
+        for block in blocks:
+            first, group, w = _block(block)
+            r = self.y[block] - y[first+group]
+            within_chi2 += np.dot(w*r, r)
+        spread = self.x[np.r_[starts[1:], self.num_points]-1] - self.x[starts]
+
+        reduced = Dataset.from_arrays(x, y, 1/np.sqrt(w_sum))
+        reduced.absolute_sigma = self.absolute_sigma
+        reduced.num_raw_points = self.num_raw_points
+        reduced.chi2_offset = self.chi2_offset + within_chi2
+        reduced.raw = self if self.raw is None else self.raw
+        reduced.reduction = {'mode': mode,
+                             'num_raw_points': reduced.num_raw_points,
+                             'num_points': reduced.num_points,
+                             'max_spread': float(np.max(spread)) if len(spread) else 0.0}
+        return reduced
@@ -0,0 +1,231 @@
+####################################################################################
+#                                    LIBRARIES                                     #
+####################################################################################
+
+import ast
+import numpy as np
+import scipy.special as sp
+
+####################################################################################
+#                  Models compiled from expression strings                         #
+####################################################################################
+
+# Functions and constants allowed in expressions (all vectorized NumPy/SciPy ufuncs)
+_FUNCTIONS = {
+    'exp': np.exp, 'log': np.log, 'log10': np.log10, 'sqrt': np.sqrt,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'arcsin': np.arcsin, 'arccos': np.arccos, 'arctan': np.arctan,
+    'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'abs': np.abs, 'sign': np.sign, 'erf': sp.erf, 'gamma': sp.gamma,
+}
+_CONSTANTS = {'pi': np.pi}
+# Names available to the compiled code, including helpers only used by derivatives
+# (digamma, for gamma), which are reserved rather than usable in expressions
+_NAMESPACE = {**_FUNCTIONS, **_CONSTANTS, 'digamma': sp.digamma}
+
+_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow)
+_UNARYOPS = (ast.UAdd, ast.USub)
+
+# Compiled expressions, keyed by their normalized source
+_cache = {}
+
+class CompiledExpression():
+
+    # func(x, *params) evaluates the expression and jac(x, *params) returns a tuple
+    # with its analytic derivative with respect to each parameter (possibly scalars,
+    # for derivatives that do not depend on x)
+    def __init__(self, source, params, func, jac):
+        self.source = source
+        self.params = params
+        self.func = func
+        self.jac = jac
+
+# Parse, differentiate and compile an expression in x, e.g. "y0 + A*exp(-x/tau)".
+# Parameters are the remaining names, in order of first appearance.
+def compile_expression(expression):
+    try:
+        tree = ast.parse(expression.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError(f'Could not parse expression \'{expression}\'.')
+    _validate(tree)
+    source = ast.unparse(tree)
+    if(source in _cache):
+        return _cache[source]
+
+    params = _find_params(tree)
+    if(len(params) == 0):
+        raise ValueError('Expression must have at least one parameter.')
+    signature = ', '.join(['x'] + params)
+    func = eval(f'lambda {signature}: {source}', dict(_NAMESPACE))
+    derivatives = [ast.unparse(_diff(tree, p)) for p in params]
+    jac = eval(f'lambda {signature}: ({", ".join(derivatives)},)', dict(_NAMESPACE))
+
+    compiled = CompiledExpression(source, params, func, jac)
+    _cache[source] = compiled
+    return compiled
+
+def _validate(node):
+    if(isinstance(node, ast.BinOp)):
+        if(isinstance(node.op, ast.BitXor)):
+            raise ValueError('Use \'**\' rather than \'^\' for powers.')
+        if(not isinstance(node.op, _BINOPS)):
+            raise ValueError(f'Operator \'{type(node.op).__name__}\' is not supported.')
+        _validate(node.left)
+        _validate(node.right)
+    elif(isinstance(node, ast.UnaryOp)):
+        if(not isinstance(node.op, _UNARYOPS)):
+            raise ValueError(f'Operator \'{type(node.op).__name__}\' is not supported.')
+        _validate(node.operand)
+    elif(isinstance(node, ast.Call)):
+        if(not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS):
+            raise ValueError(f'Unsupported function in \'{ast.unparse(node)}\'. Supported functions are: {", ".join(_FUNCTIONS)}.')
+        if(len(node.args) != 1 or node.keywords):
+            raise ValueError(f'Function \'{node.func.id}\' takes exactly one argument.')
+        _validate(node.args[0])
+    elif(isinstance(node, ast.Name)):
+        if(node.id in _FUNCTIONS):
+            raise ValueError(f'\'{node.id}\' is a function and cannot be used as a variable.')
+        if(node.id in _NAMESPACE and node.id not in _CONSTANTS):
+            raise ValueError(f'\'{node.id}\' is a reserved name and cannot be used as a variable.')
+    elif(isinstance(node, ast.Constant)):
+        if(isinstance(node.value, bool) or not isinstance(node.value, (int, float))):
+            raise ValueError(f'Constant \'{node.value!r}\' is not a number.')
+    else:
+        raise ValueError(f'Expression element \'{ast.unparse(node)}\' is not supported.')
+
+def _find_params(tree):
+    names = [n for n in ast.walk(tree) if isinstance(n, ast.Name) and n.id not in _NAMESPACE and n.id != 'x']
+    names.sort(key=lambda n: (n.lineno, n.col_offset))
+    params = []
+    for n in names:
+        if(n.id not in params):
+            params.append(n.id)
+    return params
+
+################################## DIFFERENTIATION ##################################
+
+# Node builders with constant folding of the trivial cases (0 and 1), so that the
+# derivatives don't carry around terms like 0*x or 1*A
+
+def _num(value):
+    return ast.Constant(value=value)
+
+def _is_num(node, value=None):
+    if(not isinstance(node, ast.Constant)):
+        return False
+    return value is None or node.value == value
+
+def _add(a, b):
+    if(_is_num(a, 0)):
+        return b
+    if(_is_num(b, 0)):
+        return a
+    return ast.BinOp(left=a, op=ast.Add(), right=b)
+
+def _sub(a, b):
+    if(_is_num(b, 0)):
+        return a
+    if(_is_num(a, 0)):
+        return _neg(b)
+    return ast.BinOp(left=a, op=ast.Sub(), right=b)
+
+def _mul(a, b):
+    if(_is_num(a, 0) or _is_num(b, 0)):
+        return _num(0)
+    if(_is_num(a, 1)):
+        return b
+    if(_is_num(b, 1)):
+        return a
+    return ast.BinOp(left=a, op=ast.Mult(), right=b)
+
+def _div(a, b):
+    if(_is_num(a, 0)):
+        return _num(0)
+    if(_is_num(b, 1)):
+        return a
+    return ast.BinOp(left=a, op=ast.Div(), right=b)
+
+def _pow(a, b):
+    if(_is_num(b, 1)):
+        return a
+    return ast.BinOp(left=a, op=ast.Pow(), right=b)
+
+def _neg(a):
+    if(_is_num(a, 0)):
+        return a
+    return ast.UnaryOp(op=ast.USub(), operand=a)
+
+def _call(name, arg):
+    return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=[arg], keywords=[])
+
+def _depends_on(node, var):
+    return any(isinstance(n, ast.Name) and n.id == var for n in ast.walk(node))
+
+# Derivative of a (validated) expression tree with respect to the name var
+def _diff(node, var):
+    if(not _depends_on(node, var)):
+        return _num(0)
+    if(isinstance(node, ast.Name)):
+        return _num(1)
+    if(isinstance(node, ast.UnaryOp)):
+        d = _diff(node.operand, var)
+        return _neg(d) if isinstance(node.op, ast.USub) else d
+    if(isinstance(node, ast.BinOp)):
+        u, v = node.left, node.right
+        du, dv = _diff(u, var), _diff(v, var)
+        if(isinstance(node.op, ast.Add)):
+            return _add(du, dv)
+        if(isinstance(node.op, ast.Sub)):
+            return _sub(du, dv)
+        if(isinstance(node.op, ast.Mult)):
+            return _add(_mul(du, v), _mul(u, dv))
+        if(isinstance(node.op, ast.Div)):
+            if(_is_num(dv, 0)):
+                return _div(du, v)
+            return _div(_sub(_mul(du, v), _mul(u, dv)), _pow(v, _num(2)))
+        if(isinstance(node.op, ast.Pow)):
+            if(_is_num(dv, 0)):
+                # d(u**c) = c*u**(c-1)*du
+                return _mul(_mul(v, _pow(u, _sub(v, _num(1)) if not _is_num(v) else _num(v.value-1))), du)
+            # d(u**v) = u**v*(dv*log(u) + v*du/u)
+            return _mul(node, _add(_mul(dv, _call('log', u)), _div(_mul(v, du), u)))
+    if(isinstance(node, ast.Call)):
+        u = node.args[0]
+        du = _diff(u, var)
+        name = node.func.id
+        if(name == 'exp'):
+            outer = node
+        elif(name == 'log'):
+            outer = _div(_num(1), u)
+        elif(name == 'log10'):
+            outer = _div(_num(1), _mul(u, _call('log', _num(10))))
+        elif(name == 'sqrt'):
+            outer = _div(_num(1), _mul(_num(2), node))
+        elif(name == 'sin'):
+            outer = _call('cos', u)
+        elif(name == 'cos'):
+            outer = _neg(_call('sin', u))
+        elif(name == 'tan'):
+            outer = _div(_num(1), _pow(_call('cos', u), _num(2)))
+        elif(name == 'arcsin'):
+            outer = _div(_num(1), _call('sqrt', _sub(_num(1), _pow(u, _num(2)))))
+        elif(name == 'arccos'):
+            outer = _neg(_div(_num(1), _call('sqrt', _sub(_num(1), _pow(u, _num(2))))))
+        elif(name == 'arctan'):
+            outer = _div(_num(1), _add(_num(1), _pow(u, _num(2))))
+        elif(name == 'sinh'):
+            outer = _call('cosh', u)
+        elif(name == 'cosh'):
+            outer = _call('sinh', u)
+        elif(name == 'tanh'):
+            outer = _sub(_num(1), _pow(node, _num(2)))
+        elif(name == 'abs'):
+            outer = _call('sign', u)
+        elif(name == 'sign'):
+            return _num(0)
+        elif(name == 'erf'):
+            outer = _mul(_div(_num(2), _call('sqrt', ast.Name(id='pi', ctx=ast.Load()))), _call('exp', _neg(_pow(u, _num(2)))))
+        elif(name == 'gamma'):
+            outer = _mul(node, _call('digamma', u))
+        return _mul(outer, du)
+    raise ValueError(f'Cannot differentiate \'{ast.unparse(node)}\'.')
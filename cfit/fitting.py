@@ -2,11 +2,16 @@
 #                                    LIBRARIES                                     #
 ####################################################################################
 
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy.optimize as opt
+import scipy.sparse as sparse
 import scipy.stats as stats
 
+from . import chunked
+from .results import FitResult
 from .guess_params import *
 
 ####################################################################################
@@ -15,16 +20,23 @@ from .guess_params import *
 
 class Fit():
     
-    def __init__(self, dataset, function, auto=True, ini_params=None):
+    def __init__(self, dataset, function, auto=True, ini_params=None, max_points=None, chunk_size=None, time_limit=None, max_evals=None, guess_method='de'):
         
         #Store the dataset and function
         self.dataset = dataset
         self.function = function
         
         #If no initial parameters are given, use the auto_ini_params function
+        #(on a subsample of at most max_points points, if given, for large datasets),
+        #within the time_limit (in seconds) and max_evals chi2 evaluations, if given,
+        #with the global search done by guess_method ('de' or 'multistart')
+        #and its chi2 evaluations done block by block if chunk_size is given
+        start = time.perf_counter()
+        budget = Budget(time_limit=time_limit, max_evals=max_evals)
         if(auto):
             try:
-                self.ini_params = guess_params(dataset,function)
+                self.ini_params = guess_params(dataset,function,max_points=max_points,budget=budget,
+                                               method=guess_method,chunk_size=chunk_size)
             except ValueError as e:
                 raise ValueError(f'Could not guess initial parameters. {e}')
         else:
@@ -38,26 +50,290 @@ class Fit():
                 except ValueError:
                     raise ValueError('Initial parameters must be numeric.')
             self.ini_params = ini_params
+        guess_time = time.perf_counter() - start
+        self.budget_hit = budget.hit
             
         #Perform the fit. Note that sigma=None is equivalent to sigma=1
         #absolute_sigma=True forces the errors to not be used in a relative manner (often what is needed?)
-        sig_flag = False if dataset.y_err is None else True
+        #The covariance is always computed with absolute errors here and, for relative
+        #errors, scaled below by the reduced chi2 of the original (unreduced) data.
+        #If chunk_size is given, the fit is done block by block (see chunked.py) so
+        #that no full-length residual or Jacobian arrays are ever allocated
+        sig_flag = dataset.absolute_sigma
+        start = time.perf_counter()
         try:
-            fit_struct = opt.curve_fit(function, 
-                        dataset.x, dataset.y, sigma=dataset.y_err,
-                        p0=self.ini_params,
-                        absolute_sigma=sig_flag,
-                        )
+            if(chunk_size is None):
+                fit_struct = opt.curve_fit(function, 
+                            dataset.x, dataset.y, sigma=dataset.y_err,
+                            p0=self.ini_params,
+                            absolute_sigma=True,
+                            jac=None if function.jac is None else (lambda x, *p: function.jacobian(x, p)),
+                            )
+            else:
+                fit_struct = chunked.curve_fit(function, dataset,
+                            p0=self.ini_params,
+                            chunk_size=chunk_size,
+                            absolute_sigma=True,
+                            )
         except RuntimeError as e:
             if str(e).startswith('Optimal parameters not found'):
                 raise RuntimeError('Could not find optimal parameters. Try changing the initial parameters.')
 
-        #Unwrapping the fit parameters and covariance matrix
+        self.timings = {'guess': guess_time, 'fit': time.perf_counter() - start}
+
+        #Calculate the goodness of fit. For approximately binned datasets the chi2 of
+        #the binned points is not that of the original data, so it is evaluated on the
+        #raw points (and the binned value is kept as a diagnostic)
         self.fit_params = fit_struct[0]
-        self.fit_errors = np.sqrt(np.diag(fit_struct[1]))
-        
+        dof = dataset.num_raw_points - function.num_params
+        self.dof = dof
+        self.binned_red_chi2 = None
+        if(dataset.reduction is not None and dataset.reduction['mode'] != 'exact'):
+            self.binned_red_chi2 = function.chi2(self.fit_params,dataset,chunk_size=chunk_size)/dof
+            self.red_chi2 = function.chi2(self.fit_params,dataset.raw,chunk_size=chunk_size)/dof
+        else:
+            self.red_chi2 = function.chi2(self.fit_params,dataset,chunk_size=chunk_size)/dof
+        p_values = [0.95,0.05] # 95% and 5% confidence levels
+        self.red_chi2_limits = stats.chi2.isf(p_values,dof)/dof
+
+        #Unwrapping the covariance matrix
+        self.fit_cov = fit_struct[1] if sig_flag else fit_struct[1]*self.red_chi2
+        self.fit_errors = np.sqrt(np.diag(self.fit_cov))
+
+    # Slim, picklable summary of this fit (see results.py)
+    def to_result(self):
+        return FitResult.from_fit(self)
+
+    # Confidence band (lower, upper) of the best-fit curve at the points x, at the
+    # given confidence level, propagated from the covariance by the delta method
+    def confidence_band(self, x, level=0.95):
+        y_fit = self.function(np.asarray(x, dtype=float), *self.fit_params)
+        width = self._band_width(x, level, prediction=False)
+        return y_fit - width, y_fit + width
+
+    # Prediction band (lower, upper) for new measurements at the points x, i.e. the
+    # confidence band widened by the measurement scatter
+    def prediction_band(self, x, level=0.95):
+        y_fit = self.function(np.asarray(x, dtype=float), *self.fit_params)
+        width = self._band_width(x, level, prediction=True)
+        return y_fit - width, y_fit + width
+
+    def _band_width(self, x, level, prediction):
+        x = np.asarray(x, dtype=float)
+        J = self.function.jacobian(x, self.fit_params)
+        var = np.sum((J @ self.fit_cov)*J, axis=1)
+        if(prediction):
+            #Measurement variance: interpolated y_err^2 if errors were given,
+            #otherwise the residual variance (y_err=1 so chi2/dof)
+            if(self.dataset.absolute_sigma):
+                raw = self.dataset if self.dataset.raw is None else self.dataset.raw
+                var = var + np.interp(x, raw.x, raw.y_err)**2
+            else:
+                var = var + self.red_chi2
+        #Student-t quantile when the errors are only relative, normal otherwise
+        q = (1+level)/2
+        if(not self.dataset.absolute_sigma and self.dof > 0):
+            factor = stats.t.ppf(q, self.dof)
+        else:
+            factor = stats.norm.ppf(q)
+        return factor*np.sqrt(np.maximum(var, 0))
+
+    # Index of a parameter given by name or position
+    def _param_index(self, param):
+        if(isinstance(param, str)):
+            if(param not in self.function.params):
+                raise ValueError(f'Unknown parameter \'{param}\'.')
+            return self.function.params.index(param)
+        if(not 0 <= param < self.function.num_params):
+            raise ValueError('Parameter index out of range.')
+        return int(param)
+
+    # Grid of values of a parameter, by default the best fit +/- 3 errors
+    def _param_values(self, idx, param_range, n):
+        if(param_range is None):
+            error = self.fit_errors[idx]
+            if(not np.isfinite(error) or error == 0):
+                error = max(abs(self.fit_params[idx]), 1.0)*0.1
+            param_range = (self.fit_params[idx] - 3*error, self.fit_params[idx] + 3*error)
+        return np.linspace(param_range[0], param_range[1], n)
+
+    # Chi2 surface over two parameters with the others fixed at the best fit.
+    # Returns (a_values, b_values, chi2) with chi2[i,j] at (a_values[i], b_values[j]).
+    # The grid is evaluated as batches of parameter sets, with at most max_elements
+    # model values held in memory at a time.
+    def chi2_grid(self, param_a, param_b, ranges=None, n=50, max_elements=2**16):
+        ia = self._param_index(param_a)
+        ib = self._param_index(param_b)
+        if(ia == ib):
+            raise ValueError('The two parameters of a chi2 grid must be different.')
+        ranges = (None, None) if ranges is None else ranges
+        a_values = self._param_values(ia, ranges[0], n)
+        b_values = self._param_values(ib, ranges[1], n)
+
+        P = np.tile(np.asarray(self.fit_params, dtype=float), (n*n, 1))
+        A, B = np.meshgrid(a_values, b_values, indexing='ij')
+        P[:, ia] = A.ravel()
+        P[:, ib] = B.ravel()
+        chunk_size = max(1, max_elements//max(self.dataset.num_points, 1))
+        with np.errstate(all='ignore'):
+            chi2 = self.function.chi2_batch(P, self.dataset, chunk_size=chunk_size)
+        return a_values, b_values, chi2.reshape(n, n)
+
+    # Profile chi2 of one parameter: at each grid value the parameter is fixed and
+    # the others re-optimized. Starting from the grid point nearest the best fit,
+    # the two directions are walked in parallel, each fit warm-started from its
+    # neighbour. Returns (values, chi2, params) with params of shape (n, num_params).
+    def profile(self, param, param_range=None, n=50):
+        idx = self._param_index(param)
+        values = self._param_values(idx, param_range, n)
+        free = [i for i in range(self.function.num_params) if i != idx]
+        chi2 = np.full(n, np.nan)
+        params = np.full((n, self.function.num_params), np.nan)
+
+        def _walk(indices):
+            p0 = np.delete(np.asarray(self.fit_params, dtype=float), idx)
+            for i in indices:
+                full = np.asarray(self.fit_params, dtype=float).copy()
+                full[idx] = values[i]
+                if(len(free) > 0):
+                    def _fixed(x, *p):
+                        full[free] = p
+                        return self.function.func(x, *full)
+                    try:
+                        with warnings.catch_warnings():
+                            warnings.filterwarnings('ignore')
+                            p0 = opt.curve_fit(_fixed, self.dataset.x, self.dataset.y, sigma=self.dataset.y_err, p0=p0)[0]
+                    except (RuntimeError, ValueError):
+                        continue
+                    full[free] = p0
+                params[i] = full
+                chi2[i] = self.function.chi2(full, self.dataset)
+
+        centre = int(np.argmin(np.abs(values - self.fit_params[idx])))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(_walk, [range(centre, n), range(centre-1, -1, -1)]))
+        return values, chi2, params
+
+####################################################################################
+#                                 CLASS: GlobalFit                                 #
+####################################################################################
+
+class GlobalFit():
+
+    # Joint fit of one function to K datasets, with the parameters named in shared
+    # (a name or a list of names) tied across all datasets and the rest fitted per
+    # dataset. The residuals of dataset k depend only on the shared and its own
+    # local parameters, so the Jacobian is block-sparse: finite differences need
+    # only (shared + local) evaluations regardless of K, and the covariance is
+    # obtained blockwise via the Schur complement, so the cost scales linearly
+    # with K.
+    def __init__(self, datasets, function, shared, auto=True, ini_params=None):
+
+        #Store the datasets and function
+        self.datasets = list(datasets)
+        self.function = function
+        K = len(self.datasets)
+        if(K == 0):
+            raise ValueError('No datasets were given.')
+        if(isinstance(shared, str)):
+            shared = [shared]
+        for param in shared:
+            if(param not in function.params):
+                raise ValueError(f'Unknown parameter \'{param}\'.')
+        self.shared = [p for p in function.params if p in shared]
+        shared_idx = [function.params.index(p) for p in self.shared]
+        local_idx = [i for i in range(function.num_params) if i not in shared_idx]
+        s = len(shared_idx)
+        l = len(local_idx)
+
+        #Initial parameters of shape (K, num_params): the per-dataset guesses,
+        #with each shared parameter started at the median over the datasets
+        if(auto):
+            try:
+                P0 = np.array([guess_params(d, function) for d in self.datasets], dtype=float)
+            except ValueError as e:
+                raise ValueError(f'Could not guess initial parameters. {e}')
+        else:
+            if(ini_params is None):
+                raise ValueError('No initial parameters were given.')
+            try:
+                P0 = np.array(ini_params, dtype=float).reshape(K, function.num_params)
+            except ValueError:
+                raise ValueError('Initial parameters must be numeric and of shape (number of datasets, number of function parameters).')
+        self.ini_params = P0
+        theta0 = np.concatenate([np.median(P0[:, shared_idx], axis=0), P0[:, local_idx].ravel()])
+
+        #Row ranges of each dataset in the stacked residual vector
+        sizes = [d.num_points for d in self.datasets]
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+
+        def _unpack(theta):
+            P = np.empty((K, function.num_params))
+            P[:, shared_idx] = theta[:s]
+            P[:, local_idx] = theta[s:].reshape(K, l)
+            return P
+
+        def _residuals(theta):
+            P = _unpack(theta)
+            r = np.empty(bounds[-1])
+            for k, d in enumerate(self.datasets):
+                rk = d.y - function.func(d.x, *P[k])
+                r[bounds[k]:bounds[k+1]] = rk if d.y_err is None else rk/d.y_err
+            return r
+
+        #Sparsity pattern: rows of dataset k touch the shared and the k-th local columns
+        rows = []
+        cols = []
+        for k in range(K):
+            cols_k = np.concatenate([np.arange(s), s + k*l + np.arange(l)])
+            rows.append(np.repeat(np.arange(bounds[k], bounds[k+1]), len(cols_k)))
+            cols.append(np.tile(cols_k, sizes[k]))
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        sparsity = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(bounds[-1], s + K*l)).tocsr()
+
+        #Perform the joint fit
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore')
+            res = opt.least_squares(_residuals, theta0, jac_sparsity=sparsity, x_scale='jac')
+        if(not res.success):
+            raise RuntimeError('Could not find optimal parameters. Try changing the initial parameters.')
+
+        #Blockwise covariance of the arrowhead normal matrix J^T J
+        J = sparse.csr_matrix(res.jac)
+        C = np.zeros((s, s))
+        A_inv = []
+        B = []
+        for k in range(K):
+            Jk = J[bounds[k]:bounds[k+1]]
+            Js = Jk[:, :s].toarray()
+            Jl = Jk[:, s+k*l:s+(k+1)*l].toarray()
+            A_inv.append(np.linalg.pinv(Jl.T @ Jl))
+            B.append(Jl.T @ Js)
+            C += Js.T @ Js
+        schur = C - sum(B[k].T @ A_inv[k] @ B[k] for k in range(K))
+        cov_shared = np.linalg.pinv(schur)
+        cov = np.zeros((K, function.num_params, function.num_params))
+        for k in range(K):
+            AB = A_inv[k] @ B[k]
+            cov[k][np.ix_(shared_idx, shared_idx)] = cov_shared
+            cov[k][np.ix_(local_idx, local_idx)] = A_inv[k] + AB @ cov_shared @ AB.T
+            cov[k][np.ix_(local_idx, shared_idx)] = -AB @ cov_shared
+            cov[k][np.ix_(shared_idx, local_idx)] = (-AB @ cov_shared).T
+
+        #Scale as curve_fit does when the errors are only relative
+        chi2 = 2*res.cost + sum(d.chi2_offset for d in self.datasets)
+        dof = sum(d.num_raw_points for d in self.datasets) - (s + K*l)
+        if(not all(d.absolute_sigma for d in self.datasets)):
+            cov = cov*chi2/dof if dof > 0 else np.full_like(cov, np.inf)
+
+        #Unwrapping the fit parameters and covariance matrices, of shape (K, ...)
+        self.fit_params = _unpack(res.x)
+        self.fit_cov = cov
+        self.fit_errors = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+
         #Calculate the goodness of fit
-        dof = dataset.num_points - function.num_params
-        self.red_chi2 = function.chi2(self.fit_params,dataset)/dof
+        self.dof = dof
+        self.red_chi2 = chi2/dof
         p_values = [0.95,0.05] # 95% and 5% confidence levels
-        self.red_chi2_limits = stats.chi2.isf(p_values,dof)/dof
\ No newline at end of file
+        self.red_chi2_limits = stats.chi2.isf(p_values,dof)/dof
@@ -6,36 +6,134 @@ import inspect
 import numpy as np
 import scipy.special as sp
 
+from . import chunked
+from .expression import compile_expression
+
 ####################################################################################
 #                                  CLASS: Function                                 #
 ####################################################################################
 
 class Function():
     
-    def __init__(self, name, func, string):
+    def __init__(self, name, func, string, jac=None, expression=None):
         self.name = name
         self.func = func
         self.string = string
+        self.jac = jac # analytic derivatives jac(x, *params), if available
+        self.expression = expression # source expression, for compiled models
         self.params = list(inspect.signature(self.func).parameters.keys())[1:]
         self.num_params = len(self.params)
 
+    # Build a function from an expression string in x, e.g. "y0 + A*exp(-x/tau)",
+    # compiled to a vectorized kernel with analytic derivatives (see expression.py)
+    @classmethod
+    def from_expression(cls, name, expression, string=None):
+        compiled = compile_expression(expression)
+        if(string is None):
+            string = '$y = {}$'.format(compiled.source.replace('**', '^').replace('*', r' \cdot '))
+        return cls(name=name, func=compiled.func, string=string, jac=compiled.jac, expression=expression)
+
+    # Compiled models are pickled by their expression and recompiled (from the
+    # cache) when unpickled, so they can be sent to process pools
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if(self.expression is not None):
+            del state['func'], state['jac']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if(self.expression is not None):
+            compiled = compile_expression(self.expression)
+            self.func = compiled.func
+            self.jac = compiled.jac
+
     def __call__(self, x, *args):
         return self.func(x, *args)
     
     def __str__(self):
         return self.name
     
+    # Evaluate the function for many parameter sets at once. P has shape
+    # (k, num_params) and the result has shape (k, len(x)). The parameters are
+    # broadcast as column vectors against x as a row vector, so no Python loop
+    # runs over the parameter sets; chunk_size caps how many rows are evaluated
+    # at a time (and hence the size of the temporaries).
+    def evaluate_batch(self, x, P, chunk_size=None, out=None):
+        x = np.asarray(x, dtype=float)
+        P = np.atleast_2d(np.asarray(P, dtype=float))
+        if(P.ndim != 2 or P.shape[1] != self.num_params):
+            raise ValueError('Parameter matrix must have shape (k, number of function parameters).')
+        if(out is None):
+            out = np.empty((len(P), len(x)))
+        if(chunk_size is None):
+            chunk_size = max(len(P), 1)
+        for block in chunked.iter_chunks(len(P), chunk_size):
+            out[block] = self.func(x[None, :], *P[block].T[:, :, None])
+        return out
+
+    # Chi2 values for many parameter sets at once, of shape (k,). The residuals of
+    # each block are formed in place in the model output, so a block needs only the
+    # temporaries of one model evaluation.
+    def chi2_batch(self, P, dataset, chunk_size=None):
+        P = np.atleast_2d(np.asarray(P, dtype=float))
+        if(P.ndim != 2 or P.shape[1] != self.num_params):
+            raise ValueError('Parameter matrix must have shape (k, number of function parameters).')
+        if(chunk_size is None):
+            chunk_size = max(len(P), 1)
+        x = np.asarray(dataset.x, dtype=float)[None, :]
+        y = np.asarray(dataset.y, dtype=float)
+        inv_err = None if dataset.y_err is None else 1/np.asarray(dataset.y_err, dtype=float)
+        chi2 = np.empty(len(P))
+        for block in chunked.iter_chunks(len(P), chunk_size):
+            r = np.asarray(self.func(x, *P[block].T[:, :, None]), dtype=float)
+            if(r.shape != (block.stop - block.start, len(y)) or not r.flags.writeable):
+                r = np.broadcast_to(r, (block.stop - block.start, len(y))).copy()
+            np.subtract(y, r, out=r)
+            if(inv_err is not None):
+                r *= inv_err
+            chi2[block] = np.einsum('ij,ij->i', r, r) + dataset.chi2_offset
+        return chi2
+
+    # Jacobian d(y_fit)/d(params) at the points x, of shape (len(x), num_params).
+    # Analytic if available, otherwise by central differences with all shifted
+    # parameter sets evaluated as one batch
+    def jacobian(self, x, params):
+        params = np.asarray(params, dtype=float)
+        if(len(params) != self.num_params):
+            raise ValueError('Number of parameters does not match the number of function parameters.')
+        if(self.jac is not None):
+            x = np.asarray(x, dtype=float)
+            return np.column_stack([np.broadcast_to(d, x.shape) for d in self.jac(x, *params)])
+        steps = np.cbrt(np.finfo(float).eps)*np.maximum(1.0, np.abs(params))
+        P = np.concatenate([params + np.diag(steps), params - np.diag(steps)])
+        Y = self.evaluate_batch(x, P)
+        k = self.num_params
+        return ((Y[:k] - Y[k:])/(2*steps[:, None])).T
+
     # Calculate the chi2 value for a given set of parameters and dataset
-    def chi2(self, params, dataset):
+    # (block by block if chunk_size is given, to bound memory on large datasets)
+    def chi2(self, params, dataset, chunk_size=None):
         if(len(params) != self.num_params):
             raise ValueError('Number of parameters does not match the number of function parameters.')
+        if(chunk_size is not None):
+            return chunked.chi2(self, params, dataset, chunk_size) + dataset.chi2_offset
         x = dataset.x
         y = dataset.y
         y_err = dataset.y_err if dataset.y_err is not None else 1
         y_fit = self.func(x,*params)
-        chi2 = np.sum( ((y-y_fit)/y_err)**2 )
+        chi2 = np.sum( ((y-y_fit)/y_err)**2 ) + dataset.chi2_offset # offset is non-zero for reduced datasets
         return chi2
 
+    # Calculate the weighted residuals (y-y_fit)/y_err, optionally block by block
+    # into a preallocated (e.g. memory-mapped) out array
+    def residuals(self, params, dataset, chunk_size=None, out=None):
+        if(len(params) != self.num_params):
+            raise ValueError('Number of parameters does not match the number of function parameters.')
+        if(chunk_size is None):
+            chunk_size = max(dataset.num_points, 1)
+        return chunked.residuals(self, params, dataset, chunk_size, out=out)
+
 ####################################################################################
 #                Dictionary to hold all the pre-defined functions                  #
 ####################################################################################
@@ -130,4 +228,12 @@ functions_dict = {
              func=lambda x,y0,A,x0: y0 + A*np.log(x-x0),
              string=r"$y = y_0 + A\log(x-x_0)$",
             ),
-        }
\ No newline at end of file
+        }
+
+# Register a user-defined model from an expression string, making it available in
+# functions_dict (and hence in the GUI and to guess_params' generic guesser)
+def register_function(name, expression, string=None):
+    if(name in functions_dict):
+        raise ValueError(f'A function named \'{name}\' already exists.')
+    functions_dict[name] = Function.from_expression(name, expression, string=string)
+    return functions_dict[name]
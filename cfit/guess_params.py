@@ -1,9 +1,91 @@
+import ast
 import warnings
 import numpy as np
 import scipy.optimize as opt
 import scipy.linalg as linalg
-
-def guess_params(dataset, function):
+import scipy.stats.qmc as qmc
+import time
+
+class Budget():
+
+    # Limits on the global parameter search: a wall-clock time limit (in seconds,
+    # counted from creation) and/or a maximum number of chi2 evaluations.
+    # hit is set once a search was stopped early because of the budget.
+    def __init__(self, time_limit=None, max_evals=None):
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        self.max_evals = max_evals
+        self.evals = 0
+        self.hit = False
+
+    def exhausted(self):
+        if(self.deadline is not None and time.perf_counter() >= self.deadline):
+            return True
+        if(self.max_evals is not None and self.evals >= self.max_evals):
+            return True
+        return False
+
+# Global search engines available to guess_params (method argument)
+METHODS = ['de', 'multistart']
+
+# Built-in models that are piecewise constant in their parameters
+_PIECEWISE_CONSTANT = ['Square wave']
+
+# Whether a model is piecewise constant in its parameters: a built-in one listed
+# above, or an expression model using sign
+def _is_piecewise_constant(function):
+    if(str(function) in _PIECEWISE_CONSTANT):
+        return True
+    if(function.expression is not None):
+        tree = ast.parse(function.expression.strip(), mode='eval')
+        return any(isinstance(n, ast.Call) and n.func.id == 'sign' for n in ast.walk(tree))
+    return False
+
+def guess_params(dataset, function, max_points=None, refine_factor=4, budget=None,
+                 method='de', n_starts=None, sampler='sobol', chunk_size=None):
+
+    if(budget is None):
+        budget = Budget()
+    if(method not in METHODS):
+        raise ValueError(f'Unknown guessing method \'{method}\'. Available methods are: {", ".join(METHODS)}.')
+
+    #Multi-start evaluates all its starts on the whole search dataset at once, so it
+    #is not memory-bounded by chunk_size: it must search a subsample within one chunk
+    if(method == 'multistart' and chunk_size is not None):
+        search_points = dataset.num_points if max_points is None else min(max_points, dataset.num_points)
+        if(search_points > chunk_size):
+            raise ValueError('The multistart method is not memory-bounded; with chunk_size, give max_points <= chunk_size.')
+
+    options = {'method': method, 'n_starts': n_starts, 'sampler': sampler, 'chunk_size': chunk_size}
+
+    #Guess directly on the full dataset unless a subsample size is given
+    if(max_points is None or dataset.num_points <= max_points):
+        return _guess_params(dataset, function, budget, **options)
+    if(refine_factor <= 1):
+        raise ValueError('Refinement factor must be greater than 1.')
+
+    #Coarse-to-fine: the global search runs on a binned subsample, and the guess is
+    #then refined by local fits on progressively larger subsamples. The final
+    #full-data fit is left to the caller (i.e. Fit). With a chunk_size, subsamples
+    #are kept within one chunk, so that memory stays bounded for large datasets.
+    ini_params = _guess_params(dataset.subsample(max_points, chunk_size=chunk_size), function, budget, **options)
+    num_points = max_points*refine_factor
+    while(num_points < dataset.num_points and (chunk_size is None or num_points <= chunk_size)):
+        if(budget.exhausted()):
+            #Skipping refinement stages counts as hitting the budget
+            budget.hit = True
+            break
+        subset = dataset.subsample(num_points, chunk_size=chunk_size)
+        try:
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore')
+                ini_params = opt.curve_fit(function, subset.x, subset.y, sigma=subset.y_err, p0=ini_params)[0]
+        except (RuntimeError, ValueError):
+            break
+        num_points = num_points*refine_factor
+
+    return ini_params
+
+def _guess_params(dataset, function, budget, method='de', n_starts=None, sampler='sobol', chunk_size=None):
     
     #Data and function variables
     x = dataset.x
@@ -22,7 +104,142 @@ def guess_params(dataset, function):
     ini_params = []
     
     def _wrap_chi2(params):
-        return function.chi2(params,dataset)
+        budget.evals += 1
+        chi2 = function.chi2(params,dataset,chunk_size=chunk_size)
+        return chi2 if np.isfinite(chi2) else np.inf
+
+    #Differential evolution, stopped after the current generation (keeping the best
+    #candidate so far) once the budget is exhausted. Polishing is skipped since
+    #curve_fit refines the guess anyway.
+    def _callback(xk, convergence=None):
+        if(budget.exhausted()):
+            budget.hit = True
+            return True
+        return False
+
+    def _differential_evolution(BOUNDS):
+        return opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0,polish=False,callback=_callback).x
+
+    #Multi-start: short bounded Levenberg-Marquardt solves from quasi-random starting
+    #points inside BOUNDS. All the starts are advanced together, each iteration
+    #evaluating the model for every start (and its finite-difference shifts) as one
+    #batch (see Function.evaluate_batch), with a damping factor per start. Minima
+    #closer than 0.1% of the bounds widths are merged and the best one returned.
+    #Every model evaluation counts towards the budget; once it runs out the solves
+    #stop at their best points so far.
+    def _multistart(BOUNDS):
+        lb = np.array([b[0] for b in BOUNDS], dtype=float)
+        ub = np.array([b[1] for b in BOUNDS], dtype=float)
+        ub = np.where(ub > lb, ub, np.nextafter(lb, np.inf))
+        starts = n_starts if n_starts is not None else 8*num_params
+        if(sampler == 'sobol'):
+            points = qmc.Sobol(d=num_params, seed=0).random_base2(int(np.ceil(np.log2(starts))))[:starts]
+        elif(sampler == 'lhs'):
+            points = qmc.LatinHypercube(d=num_params, seed=0).random(starts)
+        else:
+            raise ValueError(f'Unknown sampler \'{sampler}\'. Available samplers are: sobol, lhs.')
+        P = qmc.scale(points, lb, ub)
+
+        #Number of rows of P that can still be evaluated with cost model evaluations
+        #each, counting them towards the budget
+        def _affordable(rows, cost):
+            if(budget.exhausted()):
+                rows = 0
+            elif(budget.max_evals is not None):
+                rows = min(rows, (budget.max_evals - budget.evals)//cost)
+            if(rows == 0):
+                budget.hit = True
+            budget.evals += rows*cost
+            return rows
+
+        #Weighted residuals (y-y_fit)/y_err for each row of P, of shape (len(P), num_points)
+        def _residuals(P):
+            R = function.evaluate_batch(x, P)
+            np.subtract(y, R, out=R)
+            R /= y_err
+            return R
+
+        #Jacobian of the weighted model for each row of P, of shape (len(P), num_params, num_points)
+        def _jacobian(P, R):
+            if(function.jac is not None):
+                derivatives = function.jac(x[None, :], *P.T[:, :, None])
+                return np.stack([np.broadcast_to(d, R.shape) for d in derivatives], axis=1)/y_err
+            steps = np.sqrt(np.finfo(float).eps)*np.maximum(1.0, np.abs(P))
+            shifted = P[:, None, :] + steps[:, :, None]*np.eye(num_params)
+            R_shifted = _residuals(shifted.reshape(-1, num_params)).reshape(len(P), num_params, -1)
+            return (R[:, None, :] - R_shifted)/steps[:, :, None]
+
+        minima = []
+        jac_cost = 1 if function.jac is not None else num_params
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore')
+            with np.errstate(all='ignore'):
+                P = P[:_affordable(len(P), 1)]
+                R = _residuals(P)
+                chi2 = np.einsum('kn,kn->k', R, R)
+                lam = np.full(len(P), 1e-3)
+                active = np.flatnonzero(np.isfinite(chi2))
+                for _ in range(100):
+                    active = active[:_affordable(len(active), jac_cost + 1)]
+                    if(len(active) == 0):
+                        break
+                    J = _jacobian(P[active], R[active])
+                    JTJ = np.einsum('kin,kjn->kij', J, J)
+                    JTr = np.einsum('kin,kn->ki', J, R[active])
+                    D = np.maximum(np.diagonal(JTJ, axis1=1, axis2=2), 1e-300)
+                    A = JTJ + lam[active][:, None, None]*(D[:, :, None]*np.eye(num_params))
+
+                    #Parameters on a bound, with chi2 decreasing outwards, are held fixed
+                    fixed = ((P[active] <= lb) & (JTr < 0)) | ((P[active] >= ub) & (JTr > 0))
+                    JTr[fixed] = 0
+                    A[fixed[:, :, None] | fixed[:, None, :]] = 0
+                    A += fixed[:, :, None]*np.eye(num_params)
+                    try:
+                        delta = np.linalg.solve(A, JTr[:, :, None])[:, :, 0]
+                    except np.linalg.LinAlgError:
+                        delta = np.einsum('kij,kj->ki', np.linalg.pinv(A), JTr)
+                    P_new = np.clip(P[active] + delta, lb, ub)
+                    R_new = _residuals(P_new)
+                    chi2_new = np.einsum('kn,kn->k', R_new, R_new)
+                    step = P_new - P[active]
+                    predicted = np.einsum('ki,ki->k', step, 2*JTr - np.einsum('kij,kj->ki', JTJ, step))
+                    rho = (chi2[active] - chi2_new)/predicted
+
+                    #Accept the steps that reduce chi2 and relax their damping, the
+                    #more so the better the reduction was predicted (Nielsen's
+                    #update); damp the others more. Starts stop once chi2 barely
+                    #changes, they cannot move, or the damping has grown too large.
+                    better = chi2_new < chi2[active]
+                    improved = active[better]
+                    done = better & (chi2[active] - chi2_new <= 1e-8*chi2[active])
+                    done |= np.all(P_new == P[active], axis=1)
+                    P[improved] = P_new[better]
+                    R[improved] = R_new[better]
+                    chi2[improved] = chi2_new[better]
+                    relax = np.maximum(1/3, 1 - (2*np.minimum(rho, 1) - 1)**3)
+                    lam[active] = np.where(better, np.maximum(lam[active]*relax, 1e-12), lam[active]*4)
+                    done |= lam[active] > 1e10
+                    active = active[~done]
+
+        for params, value in zip(P, chi2):
+            if(not np.isfinite(value)):
+                continue
+            scaled = (params - lb)/(ub - lb)
+            if(all(np.max(np.abs(scaled - m[0])) > 1e-3 for m in minima)):
+                minima.append((scaled, value, params))
+        if(len(minima) == 0):
+            #Nothing evaluated within the budget: fall back to the centre of the bounds
+            if(budget.hit):
+                return (lb + ub)/2
+            return _differential_evolution(BOUNDS)
+        return min(minima, key=lambda m: m[1])[2]
+
+    #Piecewise-constant models have a zero gradient almost everywhere, so local
+    #solves cannot move from their starting points: these always use DE
+    def _global_search(BOUNDS):
+        if(method == 'multistart' and not _is_piecewise_constant(function)):
+            return _multistart(BOUNDS)
+        return _differential_evolution(BOUNDS)
 
     #All the parameter estimation happens here
 
@@ -70,7 +287,7 @@ def guess_params(dataset, function):
 
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore')
-            ini_params = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+            ini_params = _global_search(BOUNDS)
 
     elif(str(function)=='Square wave'):
 
@@ -111,7 +328,7 @@ def guess_params(dataset, function):
 
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore')
-            ini_params = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+            ini_params = _global_search(BOUNDS)
 
     elif(str(function)=='Gaussian'):
 
@@ -137,7 +354,10 @@ def guess_params(dataset, function):
             warnings.filterwarnings('ignore')
             bestChiSquared = np.inf
             for BOUNDS in BOUNDS_LIST:
-                tempParameters = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+                if(bestChiSquared < np.inf and budget.exhausted()):
+                    budget.hit = True
+                    break
+                tempParameters = _global_search(BOUNDS)
                 tempChiSquared = _wrap_chi2(tempParameters)
                 if(tempChiSquared < bestChiSquared):
                     bestChiSquared = tempChiSquared
@@ -166,7 +386,10 @@ def guess_params(dataset, function):
             warnings.filterwarnings('ignore')
             bestChiSquared = np.inf
             for BOUNDS in BOUNDS_LIST:
-                tempParameters = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+                if(bestChiSquared < np.inf and budget.exhausted()):
+                    budget.hit = True
+                    break
+                tempParameters = _global_search(BOUNDS)
                 tempChiSquared = _wrap_chi2(tempParameters)
                 if(tempChiSquared < bestChiSquared):
                     bestChiSquared = tempChiSquared
@@ -196,7 +419,10 @@ def guess_params(dataset, function):
             warnings.filterwarnings('ignore')
             bestChiSquared = np.inf
             for BOUNDS in BOUNDS_LIST:
-                tempParameters = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+                if(bestChiSquared < np.inf and budget.exhausted()):
+                    budget.hit = True
+                    break
+                tempParameters = _global_search(BOUNDS)
                 tempChiSquared = _wrap_chi2(tempParameters)
                 if(tempChiSquared < bestChiSquared):
                     bestChiSquared = tempChiSquared
@@ -226,7 +452,10 @@ def guess_params(dataset, function):
             warnings.filterwarnings('ignore')
             bestChiSquared = np.inf
             for BOUNDS in BOUNDS_LIST:
-                tempParameters = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+                if(bestChiSquared < np.inf and budget.exhausted()):
+                    budget.hit = True
+                    break
+                tempParameters = _global_search(BOUNDS)
                 tempChiSquared = _wrap_chi2(tempParameters)
                 if(tempChiSquared < bestChiSquared):
                     bestChiSquared = tempChiSquared
@@ -249,7 +478,7 @@ def guess_params(dataset, function):
 
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore')
-            ini_params = opt.differential_evolution(_wrap_chi2,bounds=BOUNDS,seed=0).x
+            ini_params = _global_search(BOUNDS)
 
     elif(str(function)=='Exponential'):
         
@@ -320,5 +549,18 @@ def guess_params(dataset, function):
             
         ini_params = [y0,A,x0]
 
+    else:
+
+        #Generic guess for models without a custom guesser (e.g. those registered
+        #from expressions): a global search within bounds set by the data scale
+
+        scale = 10*max(np.max(np.abs(x)), np.max(np.abs(y)), 1)
+        BOUNDS = [(-scale,scale)]*num_params
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore')
+            with np.errstate(all='ignore'):
+                ini_params = _global_search(BOUNDS)
+
     #Sending the "best guess" parameters
     return ini_params
\ No newline at end of file
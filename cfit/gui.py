@@ -37,12 +37,17 @@ _STATE_DEFAULTS = {
     'line_visible': True,
     'line_width': 1,
     'line_color': '#ff0000',
+    'band_visible': False,
+    'landscape': None,
     'show_grid': True,
     'x_log': False,
     'y_log': False,
     '_clear_all_pending': False,
 }
 
+def _rgba(hex_color, alpha):
+    return 'rgba({}, {}, {}, {})'.format(*[int(hex_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4)], alpha)
+
 def _apply_css():
 
     background = '#08111f'
@@ -50,9 +55,6 @@ def _apply_css():
     muted = '#a8b3c7'
     primary = '#134e4a'
 
-    def _rgba(hex_color, alpha):
-        return 'rgba({}, {}, {}, {})'.format(*[int(hex_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4)], alpha)
-
     st.markdown(
         f'''
         <style>
@@ -138,10 +140,7 @@ def _load_dataset(uploaded_file):
         suffix = Path(uploaded_file.name).suffix.lower()
         if suffix == '.xlsx':
             frame = pd.read_excel(BytesIO(uploaded_file.getvalue()))
-            csv_buffer = StringIO()
-            frame.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
-            st.session_state.data = dataset.Dataset(csv_buffer)
+            st.session_state.data = dataset.Dataset.from_frame(frame)
         else:
             st.session_state.data = dataset.Dataset(StringIO(uploaded_file.getvalue().decode('utf-8')))
         st.session_state.fit = None
@@ -263,6 +262,19 @@ def _build_figure():
     if st.session_state.fit is not None and st.session_state.line_visible:
         x_values = np.linspace(st.session_state.data.x[0], st.session_state.data.x[-1], 250)
         fit = st.session_state.fit
+        if st.session_state.band_visible:
+            lower, upper = fit.confidence_band(x_values, level=0.95)
+            fig.add_trace(
+                go.Scatter(
+                    x=np.concatenate([x_values, x_values[::-1]]),
+                    y=np.concatenate([upper, lower[::-1]]),
+                    fill='toself',
+                    fillcolor=_rgba(st.session_state.line_color, 0.25),
+                    line=dict(width=0),
+                    hoverinfo='skip',
+                    name='95% confidence band',
+                )
+            )
         fig.add_trace(
             go.Scatter(
                 x=x_values,
@@ -313,6 +325,62 @@ def _build_figure():
     )
     return fig
 
+def _build_landscape_figure(fit, param_a, param_b, a_values, b_values, chi2):
+    fig = go.Figure()
+    fig.add_trace(
+        go.Contour(
+            x=a_values,
+            y=b_values,
+            z=(chi2 - np.nanmin(chi2)).T,
+            colorscale='Viridis',
+            colorbar=dict(title='Δχ²'),
+            contours=dict(showlabels=True),
+        )
+    )
+    ia = fit.function.params.index(param_a)
+    ib = fit.function.params.index(param_b)
+    fig.add_trace(
+        go.Scatter(
+            x=[fit.fit_params[ia]],
+            y=[fit.fit_params[ib]],
+            mode='markers',
+            marker=dict(color=st.session_state.line_color, size=10, symbol='x'),
+            name='Best fit',
+        )
+    )
+    fig.update_layout(
+        xaxis=dict(title=dict(text=param_a)),
+        yaxis=dict(title=dict(text=param_b)),
+        margin=dict(l=4, r=4, b=4, t=10),
+        showlegend=False,
+        template='plotly_dark',
+        height=405,
+    )
+    return fig
+
+def _render_landscape_card():
+    fit = st.session_state.fit
+    with st.expander('Chi-squared landscape'):
+        if fit is None or fit.function.num_params < 2:
+            st.caption('Available for fits with at least two parameters.')
+            return
+        params = fit.function.params
+        columns = st.columns(2)
+        param_a = columns[0].selectbox('X-axis parameter', params, index=0)
+        param_b = columns[1].selectbox('Y-axis parameter', [p for p in params if p != param_a], index=0)
+
+        # The grid is only computed on request and then cached for this fit and pair of
+        # parameters, so styling reruns of the app don't recompute it
+        landscape = st.session_state.landscape
+        is_cached = (landscape is not None and landscape['fit'] is fit
+                     and landscape['params'] == (param_a, param_b))
+        if not is_cached:
+            if not st.button('Compute landscape', width='stretch'):
+                return
+            landscape = {'fit': fit, 'params': (param_a, param_b), 'grid': fit.chi2_grid(param_a, param_b, n=100)}
+            st.session_state.landscape = landscape
+        st.plotly_chart(_build_landscape_figure(fit, param_a, param_b, *landscape['grid']), width='stretch')
+
 def _render_plotting_card():
     st.markdown('<div class="cfit-section-title">3. Style your plot</div>', unsafe_allow_html=True)
 
@@ -330,6 +398,7 @@ def _render_plotting_card():
     with checkbox_columns[0]:
         st.checkbox('Show scatter', key='scatter_visible', disabled=st.session_state.data is None)
         st.checkbox('Show best fit', key='line_visible', disabled=st.session_state.fit is None)
+        st.checkbox('Show 95% band', key='band_visible', disabled=st.session_state.fit is None)
     with checkbox_columns[1]:
         st.checkbox('Show errors', key='error_visible', disabled=st.session_state.data is None)
         st.checkbox('Show grid', key='show_grid')
@@ -382,5 +451,6 @@ def render_app():
         with st.container(border=True):
             st.markdown('<div class="cfit-section-title">4. Visualize your dataset and fit</div>', unsafe_allow_html=True)
             st.plotly_chart(_build_figure(), width='stretch')
+            _render_landscape_card()
 
     st.button('Clear all', width='stretch', on_click=lambda: st.session_state.update({'_clear_all_pending': True}))
\ No newline at end of file
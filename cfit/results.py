@@ -0,0 +1,199 @@
+####################################################################################
+#                                    LIBRARIES                                     #
+####################################################################################
+
+import json
+import numpy as np
+import pandas as pd
+
+####################################################################################
+#                                 CLASS: FitResult                                 #
+####################################################################################
+
+# Timings kept for each fit (in seconds), in column order for FitResults
+TIMING_KEYS = ('guess', 'fit')
+
+class FitResult():
+
+    # Slim, picklable record of a fit: no references to the dataset or function
+    __slots__ = ('function_name', 'params', 'errors', 'cov', 'red_chi2',
+                 'red_chi2_limits', 'status', 'timings')
+
+    def __init__(self, function_name, params, errors, cov, red_chi2, red_chi2_limits,
+                 status='success', timings=None):
+        self.function_name = str(function_name)
+        self.params = np.asarray(params, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.cov = np.asarray(cov, dtype=float)
+        self.red_chi2 = float(red_chi2)
+        self.red_chi2_limits = np.asarray(red_chi2_limits, dtype=float)
+        self.status = str(status)
+        self.timings = {key: float((timings or {}).get(key, np.nan)) for key in TIMING_KEYS}
+
+    def __repr__(self):
+        return f'FitResult({self.function_name}, red_chi2={self.red_chi2:.3e}, status={self.status})'
+
+    # Status defaults to 'budget_hit' if the parameter guess was cut short
+    @classmethod
+    def from_fit(cls, fit, status=None):
+        if(status is None):
+            status = 'budget_hit' if getattr(fit, 'budget_hit', False) else 'success'
+        return cls(function_name=fit.function.name,
+                   params=fit.fit_params,
+                   errors=fit.fit_errors,
+                   cov=fit.fit_cov,
+                   red_chi2=fit.red_chi2,
+                   red_chi2_limits=fit.red_chi2_limits,
+                   status=status,
+                   timings=getattr(fit, 'timings', None))
+
+    def to_dict(self):
+        return {'function_name': self.function_name,
+                'params': self.params.tolist(),
+                'errors': self.errors.tolist(),
+                'cov': self.cov.tolist(),
+                'red_chi2': self.red_chi2,
+                'red_chi2_limits': self.red_chi2_limits.tolist(),
+                'status': self.status,
+                'timings': dict(self.timings)}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+####################################################################################
+#                                 CLASS: FitResults                                #
+####################################################################################
+
+class FitResults():
+
+    # Struct-of-arrays container for many fit results. Results of functions with
+    # fewer parameters than the widest one are NaN-padded in params/errors/cov;
+    # num_params holds the true count of each row.
+    def __init__(self, function_name, num_params, params, errors, cov, red_chi2,
+                 red_chi2_limits, status, timings):
+        self.function_name = np.asarray(function_name, dtype=str)
+        self.num_params = np.asarray(num_params, dtype=int)
+        self.params = np.asarray(params, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.cov = np.asarray(cov, dtype=float)
+        self.red_chi2 = np.asarray(red_chi2, dtype=float)
+        self.red_chi2_limits = np.asarray(red_chi2_limits, dtype=float)
+        self.status = np.asarray(status, dtype=str)
+        self.timings = np.asarray(timings, dtype=float)
+
+    _columns = ('function_name', 'num_params', 'params', 'errors', 'cov', 'red_chi2',
+                'red_chi2_limits', 'status', 'timings')
+
+    @classmethod
+    def from_results(cls, results):
+        results = list(results)
+        n = len(results)
+        k = max([len(r.params) for r in results], default=0)
+        params = np.full((n, k), np.nan)
+        errors = np.full((n, k), np.nan)
+        cov = np.full((n, k, k), np.nan)
+        for i, r in enumerate(results):
+            m = len(r.params)
+            params[i, :m] = r.params
+            errors[i, :m] = r.errors
+            cov[i, :m, :m] = r.cov
+        return cls(function_name=[r.function_name for r in results],
+                   num_params=[len(r.params) for r in results],
+                   params=params,
+                   errors=errors,
+                   cov=cov,
+                   red_chi2=[r.red_chi2 for r in results],
+                   red_chi2_limits=np.reshape([r.red_chi2_limits for r in results], (n, 2)),
+                   status=[r.status for r in results],
+                   timings=np.reshape([[r.timings[key] for key in TIMING_KEYS] for r in results], (n, len(TIMING_KEYS))))
+
+    def __len__(self):
+        return len(self.red_chi2)
+
+    # An integer gives a single FitResult; a slice, index array or boolean mask
+    # gives a new FitResults
+    def __getitem__(self, index):
+        if(np.isscalar(index)):
+            m = self.num_params[index]
+            return FitResult(function_name=self.function_name[index],
+                             params=self.params[index, :m],
+                             errors=self.errors[index, :m],
+                             cov=self.cov[index, :m, :m],
+                             red_chi2=self.red_chi2[index],
+                             red_chi2_limits=self.red_chi2_limits[index],
+                             status=self.status[index],
+                             timings=dict(zip(TIMING_KEYS, self.timings[index])))
+        return FitResults(**{c: getattr(self, c)[index] for c in self._columns})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Boolean mask of results whose reduced chi2 lies within its 5%-95% limits
+    def within_limits(self):
+        return (self.red_chi2 >= self.red_chi2_limits[:, 0]) & (self.red_chi2 <= self.red_chi2_limits[:, 1])
+
+    ################################# NPZ #################################
+
+    def to_npz(self, file_path, compressed=True):
+        save = np.savez_compressed if compressed else np.savez
+        save(file_path, **{c: getattr(self, c) for c in self._columns})
+
+    @classmethod
+    def from_npz(cls, file_path):
+        with np.load(file_path, allow_pickle=False) as data:
+            return cls(**{c: data[c] for c in cls._columns})
+
+    ############################### Parquet ###############################
+
+    # Requires a pandas Parquet engine (pyarrow or fastparquet)
+    def to_frame(self):
+        n = len(self)
+        k = self.params.shape[1]
+        return pd.DataFrame({
+            'function_name': self.function_name,
+            'num_params': self.num_params,
+            'params': list(self.params.reshape(n, k)),
+            'errors': list(self.errors.reshape(n, k)),
+            'cov': list(self.cov.reshape(n, k*k)),
+            'red_chi2': self.red_chi2,
+            'red_chi2_lower': self.red_chi2_limits[:, 0],
+            'red_chi2_upper': self.red_chi2_limits[:, 1],
+            'status': self.status,
+            **{f'time_{key}': self.timings[:, i] for i, key in enumerate(TIMING_KEYS)},
+        })
+
+    @classmethod
+    def from_frame(cls, df):
+        n = len(df)
+        num_params = df['num_params'].to_numpy(dtype=int)
+        k = num_params.max(initial=0)
+        return cls(function_name=df['function_name'].to_numpy(),
+                   num_params=num_params,
+                   params=np.array(df['params'].tolist(), dtype=float).reshape(n, k),
+                   errors=np.array(df['errors'].tolist(), dtype=float).reshape(n, k),
+                   cov=np.array(df['cov'].tolist(), dtype=float).reshape(n, k, k),
+                   red_chi2=df['red_chi2'].to_numpy(),
+                   red_chi2_limits=np.column_stack([df['red_chi2_lower'], df['red_chi2_upper']]).reshape(n, 2),
+                   status=df['status'].to_numpy(),
+                   timings=np.column_stack([df[f'time_{key}'] for key in TIMING_KEYS]).reshape(n, len(TIMING_KEYS)))
+
+    def to_parquet(self, file_path):
+        self.to_frame().to_parquet(file_path, index=False)
+
+    @classmethod
+    def from_parquet(cls, file_path):
+        return cls.from_frame(pd.read_parquet(file_path))
+
+    ################################ JSONL ################################
+
+    def to_jsonl(self, file_path):
+        with open(file_path, 'w') as f:
+            for result in self:
+                f.write(json.dumps(result.to_dict()) + '\n')
+
+    @classmethod
+    def from_jsonl(cls, file_path):
+        with open(file_path) as f:
+            return cls.from_results(FitResult.from_dict(json.loads(line)) for line in f if line.strip())
@@ -0,0 +1,299 @@
+####################################################################################
+#                                    LIBRARIES                                     #
+####################################################################################
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from . import dataset, fitting, function
+
+####################################################################################
+#                                  WORKER PROCESSES                                #
+####################################################################################
+
+# Run once in each worker process: importing this module already loads numpy, scipy,
+# pandas and cfit, and a tiny fit warms up the remaining lazily-loaded code paths
+# before the first request arrives
+def _init_worker():
+    x = np.arange(5.0)
+    fitting.Fit(dataset.Dataset.from_arrays(x, 2*x+1+0.1*(-1)**x), function.functions_dict['Linear'])
+
+# Built-in models are lambdas, which cannot be pickled, so they are sent to the
+# workers by name. Expression models are sent whole (pickled by their expression),
+# so models registered after the pool started are known to the workers too.
+def _picklable(func):
+    return func if func.expression is not None else func.name
+
+# Fit a batch of requests for the same function (see _picklable). Each payload is a
+# dict with x, y and optionally y_err, ini_params, max_points, time_limit and max_evals.
+def _fit_batch(func, payloads):
+    if(isinstance(func, str)):
+        func = function.functions_dict[func]
+    out = []
+    for payload in payloads:
+        try:
+            data = dataset.Dataset.from_arrays(payload['x'], payload['y'], payload.get('y_err'))
+            ini_params = payload.get('ini_params')
+            fit = fitting.Fit(data, func,
+                              auto=ini_params is None,
+                              ini_params=ini_params,
+                              max_points=payload.get('max_points'),
+                              time_limit=payload.get('time_limit'),
+                              max_evals=payload.get('max_evals'))
+            out.append({'ok': True, 'result': fit.to_result().to_dict()})
+        except Exception as e:
+            out.append({'ok': False, 'error': str(e)})
+    return out
+
+####################################################################################
+#                                 CLASS: FitServer                                 #
+####################################################################################
+
+class _Request():
+
+    __slots__ = ('function_name', 'payload', 'future', 'arrival')
+
+    def __init__(self, function_name, payload):
+        self.function_name = function_name
+        self.payload = payload
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+class FitServer():
+
+    # HTTP fitting service. Requests go into a bounded queue (full queue -> HTTP 503),
+    # a dispatcher thread groups queued requests for the same function into batches
+    # (waiting at most batch_window seconds for a batch to fill up to max_batch),
+    # and batches are fitted by a pool of warm worker processes. Since a batch is
+    # fitted in one worker, a group is split into at least as many batches as there
+    # are workers, so a burst is spread over the whole pool. At most two batches per
+    # worker are in flight, so a saturated pool backs up into the bounded queue.
+    def __init__(self, host='127.0.0.1', port=8000, workers=None, max_queue=1024,
+                 max_batch=8, batch_window=0.005, request_timeout=60):
+        self.host = host
+        self.port = port
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.request_timeout = request_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        workers = workers or os.cpu_count() or 1
+        self.workers = workers
+        self._pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        self._inflight = threading.BoundedSemaphore(2*workers)
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.fit_server = self
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._stopping = threading.Event()
+
+        #Metrics
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._latencies = deque(maxlen=10000)
+        self._completed = deque(maxlen=10000)
+        self._counts = {'requests': 0, 'succeeded': 0, 'failed': 0, 'rejected': 0, 'batches': 0, 'batched_requests': 0}
+
+    def serve_forever(self):
+        self._dispatcher.start()
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        if(self._stopping.is_set()):
+            return
+        self._stopping.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    # Queue a request, returning its future, or None if the queue is full
+    def submit(self, function_name, payload):
+        request = _Request(function_name, payload)
+        with self._lock:
+            self._counts['requests'] += 1
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            with self._lock:
+                self._counts['rejected'] += 1
+            return None
+        return request.future
+
+    def _dispatch(self):
+        while(not self._stopping.is_set()):
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            groups = {first.function_name: [first]}
+            deadline = time.perf_counter() + self.batch_window
+            while(max(len(g) for g in groups.values()) < self.max_batch):
+                remaining = deadline - time.perf_counter()
+                if(remaining <= 0):
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                groups.setdefault(request.function_name, []).append(request)
+            for function_name, requests in groups.items():
+                size = min(self.max_batch, -(-len(requests)//self.workers))
+                for start in range(0, len(requests), size):
+                    self._submit_batch(function_name, requests[start:start+size])
+
+    def _submit_batch(self, function_name, requests):
+        self._inflight.acquire()
+        with self._lock:
+            self._counts['batches'] += 1
+            self._counts['batched_requests'] += len(requests)
+        try:
+            func = _picklable(function.functions_dict[function_name])
+            batch = self._pool.submit(_fit_batch, func, [r.payload for r in requests])
+        except RuntimeError as e:
+            self._inflight.release()
+            for r in requests:
+                r.future.set_result({'ok': False, 'error': str(e)})
+            return
+
+        def _done(batch):
+            self._inflight.release()
+            try:
+                results = batch.result()
+            except Exception as e:
+                results = [{'ok': False, 'error': str(e)}]*len(requests)
+            now = time.perf_counter()
+            with self._lock:
+                for r, result in zip(requests, results):
+                    self._latencies.append(now - r.arrival)
+                    self._completed.append(now)
+                    self._counts['succeeded' if result['ok'] else 'failed'] += 1
+            for r, result in zip(requests, results):
+                r.future.set_result(result)
+        batch.add_done_callback(_done)
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self._latencies)
+            completed = np.array(self._completed)
+            counts = dict(self._counts)
+        now = time.perf_counter()
+        window = 60.0
+        metrics = dict(counts)
+        metrics['uptime'] = time.time() - self._started
+        metrics['queue_size'] = self._queue.qsize()
+        metrics['mean_batch_size'] = counts['batched_requests']/counts['batches'] if counts['batches'] else 0.0
+        metrics['throughput_per_s'] = float(np.sum(completed > now - window))/window if len(completed) else 0.0
+        for q in [50, 95, 99]:
+            metrics[f'latency_p{q}'] = float(np.percentile(latencies, q)) if len(latencies) else None
+        return metrics
+
+####################################################################################
+#                                   HTTP HANDLER                                   #
+####################################################################################
+
+# Replace NaN and Inf (e.g. the errors of degenerate fits) by None, i.e. JSON null,
+# since they are not valid JSON for most clients
+def _finite(obj):
+    if(isinstance(obj, float)):
+        return obj if np.isfinite(obj) else None
+    if(isinstance(obj, dict)):
+        return {key: _finite(value) for key, value in obj.items()}
+    if(isinstance(obj, (list, tuple))):
+        return [_finite(value) for value in obj]
+    return obj
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status, body):
+        data = json.dumps(_finite(body), allow_nan=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        fit_server = self.server.fit_server
+        if(self.path == '/health'):
+            self._send_json(200, {'status': 'ok'})
+        elif(self.path == '/functions'):
+            self._send_json(200, {name: f.params for name, f in function.functions_dict.items()})
+        elif(self.path == '/metrics'):
+            self._send_json(200, fit_server.metrics())
+        else:
+            self._send_json(404, {'error': 'Not found.'})
+
+    # POST /fit with a JSON body {"function": name, "x": [...], "y": [...], "y_err": [...], ...}
+    def do_POST(self):
+        fit_server = self.server.fit_server
+        if(self.path != '/fit'):
+            self._send_json(404, {'error': 'Not found.'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+            if(not isinstance(payload, dict)):
+                raise ValueError('Body is not a JSON object.')
+            function_name = payload.pop('function')
+        except (ValueError, KeyError):
+            self._send_json(400, {'error': 'Body must be a JSON object with a \'function\' field.'})
+            return
+        if(not isinstance(function_name, str) or function_name not in function.functions_dict):
+            self._send_json(400, {'error': f'Unknown function {function_name!r}.'})
+            return
+        if(not all(isinstance(payload.get(key), list) for key in ['x', 'y'])):
+            self._send_json(400, {'error': 'Body must have \'x\' and \'y\' fields with arrays of numbers.'})
+            return
+
+        future = fit_server.submit(function_name, payload)
+        if(future is None):
+            self._send_json(503, {'error': 'Server is busy, try again later.'})
+            return
+        try:
+            result = future.result(timeout=fit_server.request_timeout)
+        except TimeoutError:
+            self._send_json(504, {'error': 'Fit timed out.'})
+            return
+        if(result['ok']):
+            self._send_json(200, result['result'])
+        else:
+            self._send_json(422, {'error': result['error']})
+
+    def log_message(self, format, *args):
+        pass
+
+####################################################################################
+#                                      MAIN                                        #
+####################################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CFit HTTP fitting service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--max-queue', type=int, default=1024, help='queued requests before rejecting with HTTP 503')
+    parser.add_argument('--max-batch', type=int, default=8, help='maximum requests per batch')
+    parser.add_argument('--batch-window', type=float, default=0.005, help='seconds to wait for a batch to fill')
+    args = parser.parse_args(argv)
+
+    server = FitServer(host=args.host, port=args.port, workers=args.workers,
+                       max_queue=args.max_queue, max_batch=args.max_batch,
+                       batch_window=args.batch_window)
+    print(f'Serving CFit on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()